@@ -2,19 +2,25 @@
 # 										         #
 # FILE: decrypt.py								         #
 # 										         #
-# USAGE: python decrypt.py [-h] INPUT_FILE OUTPUT_DIR	         #
+# USAGE: python decrypt.py [-h] [--batch] [--cache] [--local] [--single-file]	 #
+#                          INPUT_FILE OUTPUT_DIR					 #
 # 										         #
 # DESCRIPTION: Read a json file containing a block of transactions,               	 #
 #              decrypt the transactions using base64 api, and save the decrypted         #
 #              transactions to a JSON file.						 #
 # 											 #
 # OPTIONS: List options for the script [-h]						 #
+#          Decode transactions in one JSON-RPC batch request [--batch]		 #
+#          Reuse decoded transactions across runs [--cache]			 #
+#          Decode transactions in process with protobuf bindings [--local]	 #
+#          Save all transactions to a single file [--single-file]		 #
 # 											 #
 # ERROR CONDITIONS: exit 1 ---- Input file not found.					 #
 #                   exit 2 ---- Invalid JSON file.					 #
 #                   exit 3 ---- Invalid block file format.				 #
 #                   exit 4 ---- Output file directory not found or could not be created. #
-#                   exit 5 ---- Failed to decode transaction.				 #
+#                   exit 5 ---- Invalid or unwritable output file directory.		 #
+#                   exit 6 ---- Failed to decode transaction.				 #
 # 											 #
 # DEVELOPER: Shikhar Gupta								 #
 # DEVELOPER EMAIL: shikhar.gupta.tx@gmail.com 						 #
@@ -24,111 +30,527 @@
 # 											 #
 # ***************************************************************************************#
 
-import json
-import requests
+import asyncio
+import base64
+import binascii
+import hashlib
+import importlib
+import inspect
+import sqlite3
+import httpx
+import ijson
+import orjson
+import logging
 import os
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, nullcontext
+from pathlib import Path
 
+from json_utils import write_json
+
+
+log = logging.getLogger(__name__)
 
 url = "https://phoenix-lcd.terra.dev/cosmos/tx/v1beta1/decode"
+rpc_url = "https://phoenix-rpc.terra.dev"
 headers = {"Content-Type": "application/json"}
+# connections kept alive in the session pool, and requests allowed in flight at once,
+# over HTTP/2 the requests to a host are multiplexed on a single connection
+max_connections = 32
+max_concurrent_requests = 16
+request_timeout = 10.0
+# transport errors and these statuses are transient, and retried with exponential backoff
+max_retries = 3
+backoff_factor = 0.2
+retry_statuses = {429, 502, 503, 504}
+# threads used to serialize and write the output files
+max_write_workers = min(32, (os.cpu_count() or 1) * 4)
+# decoded transactions persisted across runs with --cache, as a sqlite database
+cache_path = os.path.join(
+    os.path.expanduser("~"), ".cache", "indexer", "decode_cache.db"
+)
+# message and public key types that can be packed in the Any fields of a transaction
+local_decode_modules = [
+    "cosmos.authz.v1beta1.tx_pb2",
+    "cosmos.bank.v1beta1.tx_pb2",
+    "cosmos.crypto.multisig.keys_pb2",
+    "cosmos.crypto.secp256k1.keys_pb2",
+    "cosmos.distribution.v1beta1.tx_pb2",
+    "cosmos.gov.v1beta1.tx_pb2",
+    "cosmos.staking.v1beta1.tx_pb2",
+    "cosmwasm.wasm.v1.tx_pb2",
+    "ibc.applications.transfer.v1.tx_pb2",
+    "ibc.core.channel.v1.tx_pb2",
+    "ibc.core.client.v1.tx_pb2",
+]
+
+# the protobuf bindings used with --local are optional
+try:
+    from google.protobuf import symbol_database
+    from google.protobuf.json_format import MessageToDict
+    from google.protobuf.message import DecodeError
+    from cosmpy.protos.cosmos.tx.v1beta1.tx_pb2 import Tx
+
+    for module in local_decode_modules:
+        importlib.import_module(f"cosmpy.protos.{module}")
+    # the api prints fields left at their default value, protobuf 5.26 renamed this option
+    if (
+        "always_print_fields_with_no_presence"
+        in inspect.signature(MessageToDict).parameters
+    ):
+        print_default_fields = {"always_print_fields_with_no_presence": True}
+    else:
+        print_default_fields = {"including_default_value_fields": True}
+except ImportError:
+    Tx = None
+
+
+def cache_key(transaction):
+    """
+    Compute the cache key of a transaction. Decoding is a pure function of the transaction bytes.
+    Args: transaction (str): The base64 encoded transaction bytes.
+    Returns:
+        str: A hash of the transaction bytes.
+    """
+    return hashlib.blake2b(transaction.encode(), digest_size=16).hexdigest()
+
+
+def open_cache(path):
+    """
+    Open the decode cache, creating it if it does not exist. sqlite locks the file, so concurrent runs can share it.
+    Args: path (str): The path to the cache database.
+    Returns:
+        sqlite3.Connection: The connection to the cache.
+    """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    cache = sqlite3.connect(path, timeout=30)
+    with cache:
+        cache.execute(
+            "CREATE TABLE IF NOT EXISTS decoded (key TEXT PRIMARY KEY, content BLOB NOT NULL)"
+        )
+    return cache
+
+
+def read_cache(cache, transaction):
+    """
+    Look up a decoded transaction in the cache.
+    Args: cache (sqlite3.Connection): The decode cache, or None if caching is disabled.
+          transaction (str): The base64 encoded transaction bytes.
+    Returns:
+        bytes: The decoded transaction, as raw JSON bytes.
+        None: If the transaction is not cached.
+    """
+    if cache is None:
+        return None
+    row = cache.execute(
+        "SELECT content FROM decoded WHERE key = ?", (cache_key(transaction),)
+    ).fetchone()
+    return row[0] if row else None
+
+
+def write_cache(cache, transaction, content):
+    """
+    Store a decoded transaction in the cache.
+    Args: cache (sqlite3.Connection): The decode cache, or None if caching is disabled.
+          transaction (str): The base64 encoded transaction bytes.
+          content (bytes): The decoded transaction, as raw JSON bytes.
+    """
+    if cache is None:
+        return
+    with cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO decoded (key, content) VALUES (?, ?)",
+            (cache_key(transaction), content),
+        )
+
+
+def match_api_json(message, data):
+    """
+    Adjust the protobuf JSON mapping of a message, in place, to the JSON the base64 api returns.
+    Unset message fields outside a oneof are printed as null, and the raw JSON bytes of cosmwasm contract messages as JSON.
+    Args: message (google.protobuf.message.Message): The decoded protobuf message.
+          data (dict): The message rendered by MessageToDict.
+    """
+    descriptor = message.DESCRIPTOR
+    if descriptor.full_name == "google.protobuf.Any":
+        # the fields of the packed message are inlined next to its "@type"
+        message_class = symbol_database.Default().GetSymbol(message.TypeName())
+        packed = message_class()
+        message.Unpack(packed)
+        match_api_json(packed, data)
+        return
+    if descriptor.full_name.startswith("google.protobuf."):
+        # other well-known types are rendered as scalars
+        return
+    for field in descriptor.fields:
+        name = field.name
+        if field.message_type is None:
+            if descriptor.full_name.startswith("cosmwasm.wasm.") and name == "msg":
+                data[name] = orjson.loads(getattr(message, name))
+            continue
+        if field.message_type.GetOptions().map_entry:
+            continue
+        if field.label == field.LABEL_REPEATED:
+            for item, item_data in zip(getattr(message, name), data.get(name, [])):
+                match_api_json(item, item_data)
+        elif message.HasField(name):
+            match_api_json(getattr(message, name), data[name])
+        elif field.containing_oneof is None:
+            # only the member that is set of a oneof is printed
+            data[name] = None
+
+
+def decode_transaction_locally(transaction):
+    """
+    Decode a single transaction in process with the cosmos protobuf bindings.
+    The fields follow the cosmpy protobuf definitions, which can be newer than the chain's, so they can include
+    fields the base64 api does not print, such as body.unordered.
+    Args: transaction (str): The base64 encoded transaction bytes.
+    Returns:
+        dict: The decoded transaction, in the same envelope as the base64 api response.
+        None: If the transaction contains a type without local bindings.
+    """
+    try:
+        tx = Tx.FromString(base64.b64decode(transaction, validate=True))
+        data = MessageToDict(
+            tx, preserving_proto_field_name=True, **print_default_fields
+        )
+        match_api_json(tx, data)
+    except (binascii.Error, DecodeError, TypeError, KeyError, orjson.JSONDecodeError):
+        return None
+    return {"tx": data}
+
+
+async def decode_transaction(transaction, session, semaphore, cache=None, local=False):
+    """
+    Decode a single transaction using the base64 api, retrying transient failures.
+    Args: transaction (str): The base64 encoded transaction bytes.
+          session (httpx.AsyncClient): The session shared by all requests of a block.
+          semaphore (asyncio.Semaphore): Caps the number of requests in flight.
+          cache (sqlite3.Connection): The decode cache, or None if caching is disabled.
+          local (bool): Decode in process first, only calling the api if that fails.
+    Returns:
+        dict: The decoded transaction.
+    """
+    if local:
+        decoded_response = decode_transaction_locally(transaction)
+        if decoded_response is not None:
+            return decoded_response
+    content = read_cache(cache, transaction)
+    if content is not None:
+        return orjson.loads(content)
+    for attempt in range(max_retries + 1):
+        try:
+            # hold a request slot for the request only, not while backing off
+            async with semaphore:
+                response = await session.post(
+                    url, content=orjson.dumps({"tx_bytes": transaction})
+                )
+        except httpx.TransportError:
+            # connection failures and timeouts are transient too
+            if attempt < max_retries:
+                await asyncio.sleep(backoff_factor * 2**attempt)
+                continue
+            raise
+        if response.status_code in retry_statuses and attempt < max_retries:
+            await asyncio.sleep(backoff_factor * 2**attempt)
+            continue
+        response.raise_for_status()
+        decoded_response = orjson.loads(response.content)
+        write_cache(cache, transaction, response.content)
+        return decoded_response
+
+
+async def decode_indexed_transaction(index, transaction, *args, **kwargs):
+    """
+    Decode a single transaction, keeping track of its position in the block.
+    Args: index (int): The position of the transaction in the block.
+          transaction (str): The base64 encoded transaction bytes.
+          *args, **kwargs: Passed on to decode_transaction.
+    Returns:
+        tuple: The index and the decoded transaction.
+    """
+    return index, await decode_transaction(transaction, *args, **kwargs)
 
 
-def process_and_decrypt_transaction_data(input_file_path, output_dir):
+def remove_written_files(write_results):
+    """
+    Remove the output files of a block that failed, so no partial set of files is left behind.
+    Args: write_results (list): The results of the output file writes, the path written or the exception raised.
+    """
+    for result in write_results:
+        if isinstance(result, str):
+            os.remove(result)
+
+
+def save_transactions(output_file_path, transactions):
+    """
+    Save all decoded transactions of a block to a single JSON file, as {"transactions": [...]}.
+    The array is written one transaction at a time, without building the whole document in memory,
+    with the same 2-space indentation as write_json.
+    Args: output_file_path (str): The path to the output json file.
+          transactions (list): The decoded transactions.
+    Returns:
+        str: The path to the output json file.
+    """
+    with open(output_file_path, "wb") as output_file:
+        output_file.write(b'{\n  "transactions": [\n')
+        for i, transaction in enumerate(transactions):
+            if i:
+                output_file.write(b",\n")
+            # nest each transaction two levels deep, JSON strings never hold a raw newline
+            output_file.write(b"    ")
+            output_file.write(
+                orjson.dumps(transaction, option=orjson.OPT_INDENT_2).replace(
+                    b"\n", b"\n    "
+                )
+            )
+        output_file.write(b"\n  ]\n}")
+    return output_file_path
+
+
+async def decode_transactions_batch(transactions, session, cache=None):
+    """
+    Decode all transactions in a single JSON-RPC batch request against the node's RPC endpoint.
+    Transactions found in the cache are not sent, and the decoded ones are added to it.
+    Args: transactions (list): The base64 encoded transaction bytes.
+          session (httpx.AsyncClient): The session shared by all requests of a block.
+          cache (sqlite3.Connection): The decode cache, or None if caching is disabled.
+    Returns:
+        list: The decoded transactions, in the same order as the input.
+        None: If the node does not support batched decoding.
+    """
+    decoded = {}
+    uncached = []
+    for transaction in transactions:
+        content = read_cache(cache, transaction)
+        if content is not None:
+            decoded[transaction] = orjson.loads(content)
+        else:
+            uncached.append(transaction)
+    if uncached:
+        batch = [
+            {
+                "jsonrpc": "2.0",
+                "id": i,
+                "method": "tx_decode",
+                "params": {"tx_bytes": tx},
+            }
+            for i, tx in enumerate(uncached)
+        ]
+        try:
+            response = await session.post(rpc_url, content=orjson.dumps(batch))
+            if response.status_code != 200:
+                return None
+            results = orjson.loads(response.content)
+        except (httpx.HTTPError, orjson.JSONDecodeError):
+            return None
+        # a node without batch support answers with a single object or an error per call
+        if not isinstance(results, list) or len(results) != len(uncached):
+            return None
+        results_by_id = {}
+        for result in results:
+            # each result must be in the same {"tx": ...} envelope as the base64 api response
+            if (
+                not isinstance(result, dict)
+                or not isinstance(result.get("result"), dict)
+                or "tx" not in result["result"]
+            ):
+                return None
+            results_by_id[result.get("id")] = result["result"]
+        try:
+            for i, transaction in enumerate(uncached):
+                decoded[transaction] = results_by_id[i]
+        except KeyError:
+            return None
+        for transaction in uncached:
+            write_cache(cache, transaction, orjson.dumps(decoded[transaction]))
+    return [decoded[transaction] for transaction in transactions]
+
+
+async def process_and_decrypt_transaction_data(
+    input_file_path,
+    output_dir,
+    batch=False,
+    cache=None,
+    local=False,
+    single_file=False,
+):
     """
     Read a json file, and isolate the txs special key. If the key is empty, return a message saying "no transactions found".
     If the key contains a transaction, remove any unnecessary characters and assign the transaction to variable "code".
     Decrypt the transaction using base64 api and save the decoded data to a JSON file.
     Args: input_file_path (str): The path to the input json file.
           output_dir (str): The path to the output directory to save the decrypted transactions. File will be saved with the same name as the input file, with '_decoded' appended to the end.
+          batch (bool): Try to decode all transactions in a single JSON-RPC batch request first.
+          cache (sqlite3.Connection): Decoded transactions to reuse across runs, or None to disable caching.
+          local (bool): Decode transactions in process, calling the api only for types without local bindings.
+          single_file (bool): Save all transactions to the '_decoded' file instead of one file per transaction.
     Returns:
         0: If the transactions are successfully decrypted and saved to the output file, or if there are no transactions in the input file.
         1: If the input file is not found.
         2: If the input file is not a valid JSON file.
         3: Invalid block file format.
         4: Output file directory not found or could not be created.
-        5: Invalid output file directory.
+        5: Invalid or unwritable output file directory.
         6: Failed to decode transaction.
     """
     try:
-        if not os.path.exists(input_file_path):
-            print("Input File not found.")
-            return 1
-        with open(input_file_path, "r") as input_file:
-            data = json.load(input_file)
-            if not isValidBlockFile(data):
-                print("Invalid block file format.")
-                return 3
-            transactions = data["block"]["data"]["txs"]
-            if len(transactions) == 0:
-                print("No transactions found. Output file(s) not created.")
-                return 0
-
-            # check that directory exists
-            if not os.path.exists(output_dir):
-                # try to create the directory
-                try:
-                    os.makedirs(output_dir)
-                except OSError:
-                    print("Output directory not found and could not be created.")
-                    return 4
-            elif not os.path.isdir(args.output_dir):
-                print("Please provide a valid output directory.")
-                exit(5)
-
-            output_file_path = os.path.join(
-                output_dir,
-                os.path.basename(input_file_path).replace(".json", "_decoded.json"),
-            )
+        with open(input_file_path, "rb") as input_file:
+            transactions = get_txs(input_file)
+    except FileNotFoundError:
+        log.error("Input File not found.")
+        return 1
+    except ijson.JSONError:
+        log.error("Invalid JSON file.")
+        return 2
+    if transactions is None:
+        log.error("Invalid block file format.")
+        return 3
+    if len(transactions) == 0:
+        log.info("No transactions found. Output file(s) not created.")
+        return 0
 
-            output_transactions = []
-            # decrypt transaction using base64 api
-            for transaction in transactions:
-                data = json.dumps({"tx_bytes": transaction})
-                response = requests.post(url, headers=headers, data=data)
-                if response.status_code != 200:
-                    print(
-                        f"Failed to decode transaction. Status code: {response.status_code}"
-                    )
-                    return 6
-                decoded_response = response.json()
-                output_transactions.append(decoded_response)
+    # create the directory if it does not exist
+    try:
+        os.makedirs(output_dir, exist_ok=True)
+    except FileExistsError:
+        log.error("Please provide a valid output directory.")
+        return 5
+    except OSError:
+        log.error("Output directory not found and could not be created.")
+        return 4
+    # fail before spending any network time if the files could not be written
+    if not os.access(output_dir, os.W_OK):
+        log.error("Output directory is not writable.")
+        return 5
 
-            file_paths_output = []
+    # output files are named after the input file, without its extension
+    output_file_prefix = os.path.join(output_dir, Path(input_file_path).stem)
+    output_file_path = f"{output_file_prefix}_decoded.json"
+    output_file_paths = [
+        f"{output_file_prefix}_{i+1}.json" for i in range(len(transactions))
+    ]
 
-            for i, transaction in enumerate(output_transactions):
-                output_file_path = os.path.join(
-                    output_dir,
-                    os.path.basename(input_file_path).replace(".json", f"_{i+1}.json"),
+    # decode each distinct transaction once, and fan it out to all of its positions in the block
+    positions = {}
+    for i, transaction in enumerate(transactions):
+        positions.setdefault(transaction, []).append(i)
+    unique_transactions = list(positions)
+
+    loop = asyncio.get_running_loop()
+    # only the single file is written from memory, per transaction files are written as they decode
+    output_transactions = [None] * len(transactions) if single_file else None
+    writes = []
+
+    # decrypt all transactions concurrently using base64 api, over one pooled session,
+    # and write each output file from a thread pool as soon as its transaction is decoded
+    semaphore = asyncio.Semaphore(max_concurrent_requests)
+    with ThreadPoolExecutor(max_workers=max_write_workers) as executor:
+
+        def save_decoded(transaction, decoded_transaction):
+            # record the decoded transaction at each of its positions, or queue its files
+            for i in positions[transaction]:
+                if single_file:
+                    output_transactions[i] = decoded_transaction
+                else:
+                    writes.append(
+                        loop.run_in_executor(
+                            executor,
+                            write_json,
+                            output_file_paths[i],
+                            decoded_transaction,
+                        )
+                    )
+
+        async with httpx.AsyncClient(
+            http2=True,
+            headers=headers,
+            timeout=request_timeout,
+            limits=httpx.Limits(max_connections=max_connections),
+        ) as session:
+            decoded_transactions = None
+            if batch and not local:
+                decoded_transactions = await decode_transactions_batch(
+                    unique_transactions, session, cache=cache
                 )
-                with open(output_file_path, "w") as output_file:
-                    json.dump(transaction, output_file, indent=2)
-                file_paths_output.append(output_file_path)
+                if decoded_transactions is None:
+                    log.warning(
+                        "Batched decoding not supported, decoding transactions individually."
+                    )
+                else:
+                    for transaction, decoded_transaction in zip(
+                        unique_transactions, decoded_transactions
+                    ):
+                        save_decoded(transaction, decoded_transaction)
+            if decoded_transactions is None:
+                tasks = [
+                    asyncio.create_task(
+                        decode_indexed_transaction(
+                            j,
+                            transaction,
+                            session,
+                            semaphore,
+                            cache=cache,
+                            local=local,
+                        )
+                    )
+                    for j, transaction in enumerate(unique_transactions)
+                ]
+                try:
+                    for decoded in asyncio.as_completed(tasks):
+                        j, decoded_transaction = await decoded
+                        save_decoded(unique_transactions[j], decoded_transaction)
+                except Exception as e:
+                    # fail fast, the remaining requests would be wasted
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                    # writes already running cannot be cancelled, wait for them before cleaning up
+                    remove_written_files(
+                        await asyncio.gather(*writes, return_exceptions=True)
+                    )
+                    log.error(f"Failed to decode transaction. {e!r}")
+                    return 6
+        write_results = await asyncio.gather(*writes, return_exceptions=True)
+        write_errors = [r for r in write_results if isinstance(r, Exception)]
+        if write_errors:
+            remove_written_files(write_results)
+            log.error(f"Failed to save decoded transaction. {write_errors[0]!r}")
+            return 5
 
-            print(
-                f"{len(output_transactions)} transaction(s) decoded and saved to {output_dir}"
-            )
-            return 0
+    if single_file:
+        save_transactions(output_file_path, output_transactions)
 
-    except json.JSONDecodeError:
-        print("Invalid JSON file.")
-        return 2
+    log.info(f"{len(transactions)} transaction(s) decoded and saved to {output_dir}")
+    return 0
 
 
-def isValidBlockFile(data):
+def get_txs(input_file):
     """
-    Check if the input data is a valid block file format.
+    Validate the block file format and extract its transactions in a single pass.
+    The block is streamed, so only the txs list is built, skipping headers, signatures and evidence.
+    The rest of the file is still read to the end, so truncated or trailing content is rejected.
     Args:
-        data (dict): The data loaded from the JSON file.
+        input_file (file): The block file, opened in binary mode.
     Returns:
-        bool: True if the data is a valid block file format, False otherwise.
+        list: The transactions of the block.
+        None: If the file is not a valid block file format.
     """
-    if "block" in data and "data" in data["block"] and "txs" in data["block"]["data"]:
-        return True
-    return False
+    txs = ijson.items(input_file, "block.data.txs")
+    transactions = next(txs, None)
+    for _ in txs:
+        pass
+    return transactions
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.environ.get("LOGLEVEL", "INFO"), format="%(levelname)s: %(message)s"
+    )
+    # httpx logs every request at INFO, keep only its warnings
+    logging.getLogger("httpx").setLevel(logging.WARNING)
     parser = argparse.ArgumentParser(
         description="Process and decrypt transaction data."
     )
@@ -142,10 +564,44 @@ if __name__ == "__main__":
         type=str,
         help="The path to the output json file to save the decrypted transactions. If not provided, the decoded data will be saved to a file with the same name as the input file, with '_decoded' appended to the end.",
     )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Decode all transactions in a single JSON-RPC batch request, falling back to one request per transaction if the node does not support it. Cannot be combined with --local.",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"Reuse decoded transactions across runs, stored in {cache_path}.",
+    )
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Decode transactions in process with the cosmpy protobuf bindings, calling the api only for message types without local bindings.",
+    )
+    parser.add_argument(
+        "--single-file",
+        action="store_true",
+        help="Save all decoded transactions to a single file, with '_decoded' appended to the input file name, instead of one file per transaction.",
+    )
     args = parser.parse_args()
-    if not args.input_file or not os.path.exists(args.input_file):
+    if args.local and Tx is None:
+        parser.error("--local requires the cosmpy package.")
+    if args.batch and args.local:
+        parser.error("--batch cannot be combined with --local.")
+    if not args.input_file:
         # print help message if no arguments are provided
         parser.print_help()
         exit(0)
-    return_code = process_and_decrypt_transaction_data(args.input_file, args.output_dir)
+    with closing(open_cache(cache_path)) if args.cache else nullcontext() as cache:
+        return_code = asyncio.run(
+            process_and_decrypt_transaction_data(
+                args.input_file,
+                args.output_dir,
+                batch=args.batch,
+                cache=cache,
+                local=args.local,
+                single_file=args.single_file,
+            )
+        )
     exit(return_code)
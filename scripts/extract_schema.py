@@ -24,9 +24,82 @@
 
 import sqlglot
 import sqlglot.expressions as exp
-import json
 import argparse
+import mmap
+import logging
 import os
+import re
+from functools import cache
+from pathlib import Path
+
+from json_utils import write_json
+
+
+log = logging.getLogger(__name__)
+
+# statements starting with CREATE [GLOBAL|LOCAL] [TEMP|TEMPORARY|UNLOGGED] TABLE, after
+# any leading whitespace and comments
+create_table_pattern = re.compile(
+    rb"(?:\s|--[^\n]*|/\*.*?\*/)*CREATE\s+(?:(?:GLOBAL|LOCAL)\s+)?"
+    rb"(?:(?:TEMP|TEMPORARY|UNLOGGED)\s+)?TABLE\b",
+    re.IGNORECASE | re.DOTALL,
+)
+# the tokens that can contain a ';' without ending the statement: escape and plain string
+# literals, quoted identifiers, comments and dollar quoted bodies, or the ';' itself
+statement_token_pattern = re.compile(
+    rb"(?<!\w)[Ee]'(?:[^'\\]|\\.|'')*'"
+    rb"|'(?:[^']|'')*'"
+    rb'|"(?:[^"]|"")*"'
+    rb"|--[^\n]*"
+    rb"|/\*.*?\*/"
+    rb"|\$(\w*)\$.*?\$\1\$"
+    rb"|;",
+    re.DOTALL,
+)
+dialect = "postgres"
+
+
+@cache
+def to_sql(expression):
+    """Renders a sqlglot expression, once per distinct expression.
+
+    Args:
+      expression: The sqlglot expression.
+
+    Returns:
+      The SQL string of the expression.
+    """
+    return expression.sql()
+
+
+def read_create_table_statements(sql_file):
+    """Reads the CREATE TABLE statements of a SQL file.
+
+    The file is memory mapped and split on the ';' found outside of strings,
+    quoted identifiers, comments and dollar quoted bodies, so only the CREATE
+    TABLE statements are copied out of it and decoded.
+
+    Args:
+      sql_file: The path to the SQL file.
+
+    Yields:
+      The text of each CREATE TABLE statement.
+    """
+    with open(sql_file, "rb") as f:
+        # an empty file cannot be memory mapped, and has no statements
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as sql:
+            start = 0
+            for token in statement_token_pattern.finditer(sql):
+                if token.group() != b";":
+                    continue
+                end = token.start()
+                if create_table_pattern.match(sql, start, end):
+                    yield sql[start:end].decode("utf-8")
+                start = token.end()
+            if create_table_pattern.match(sql, start):
+                yield sql[start:].decode("utf-8")
 
 
 def extract_schema(sql_file):
@@ -39,42 +112,53 @@ def extract_schema(sql_file):
       A list of dictionaries, where each dictionary represents a table in the schema.
     """
 
-    with open(sql_file, "r") as f:
-        sql = f.read()
-
-    # Parse the SQL file
-    # mute the warnings
-
-    result = sqlglot.parse(sql)
+    # Parse only the CREATE TABLE statements, the schema does not need the rest of the file
+    try:
+        statements = [
+            sqlglot.parse_one(chunk, dialect=dialect)
+            for chunk in read_create_table_statements(sql_file)
+        ]
+    except sqlglot.errors.SqlglotError as e:
+        # the statement could have been split wrongly, parse the whole file instead
+        log.warning(
+            f"Failed to parse a CREATE TABLE statement on its own, parsing the whole file: {e}"
+        )
+        with open(sql_file, "r", encoding="utf-8") as f:
+            statements = sqlglot.parse(f.read(), dialect=dialect)
 
-    # Extract the schema
     schema = []
-    for statement in result:
-        if isinstance(statement, exp.Create):
+    for statement in statements:
+        if isinstance(statement, exp.Create) and statement.args.get("kind") == "TABLE":
             args = statement.args["this"].args
             table = {}
-            table["name"] = str(args["this"])
-            table["columns"] = {}
-            for column_arg in args["expressions"]:
-                column = {}
-                if isinstance(column_arg, exp.ColumnDef):
-                    column["type"] = str(column_arg.args["kind"])
-                    column["constraints"] = [
-                        str(constraint) for constraint in column_arg.args["constraints"]
-                    ]
-                    table["columns"][str(column_arg.args["this"])] = column
-                elif isinstance(column_arg, exp.ForeignKey):
-                    name = column_arg.args["expressions"][0].args["this"]
-                    references = column_arg.args["reference"].args["this"]
-                    table["columns"][name][
-                        "constraint"
-                    ] = f"FOREIGN KEY REFERENCES {references}"
+            table["name"] = args["this"].sql()
+            columns = table["columns"] = {}
+            # partition the table expressions once, so each loop handles a single type
+            expressions = args["expressions"]
+            column_defs = [e for e in expressions if type(e) is exp.ColumnDef]
+            foreign_keys = [e for e in expressions if type(e) is exp.ForeignKey]
+            for column_def in column_defs:
+                column_args = column_def.args
+                columns[column_args["this"].name] = {
+                    "type": to_sql(column_args["kind"]),
+                    "constraints": [
+                        to_sql(constraint) for constraint in column_args["constraints"]
+                    ],
+                }
+            for foreign_key in foreign_keys:
+                foreign_key_args = foreign_key.args
+                name = foreign_key_args["expressions"][0].args["this"]
+                references = foreign_key_args["reference"].args["this"]
+                columns[name]["constraint"] = f"FOREIGN KEY REFERENCES {references}"
             schema.append(table)
 
     return schema
 
 
 if __name__ == "__main__":
+    logging.basicConfig(
+        level=os.environ.get("LOGLEVEL", "INFO"), format="%(levelname)s: %(message)s"
+    )
     parser = argparse.ArgumentParser(description="Extract the schema from a SQL file.")
     parser.add_argument(
         "sql_file",
@@ -91,34 +175,34 @@ if __name__ == "__main__":
         # print help message if no arguments are provided
         parser.print_help()
         exit(0)
-    # check that the file is a SQL file and exists
-    if not args.sql_file.endswith(".sql") or not os.path.exists(args.sql_file):
-        print("Please provide a valid SQL file.")
+    # check that the file is a SQL file, whether it exists is checked when it is read
+    if not args.sql_file.endswith(".sql"):
+        log.error("Please provide a valid SQL file.")
         exit(1)
-    # check that the output directory exists and if not, create it
-    if not os.path.exists(args.output_dir):
-        # try to create the directory
-        try:
-            os.makedirs(args.output_dir)
-        except OSError:
-            print("Output directory not found and could not be created.")
-            exit(2)
-    if not os.path.isdir(args.output_dir):
-        print("Please provide a valid output directory.")
+    # read the SQL file first, so a missing file does not leave an output directory behind
+    try:
+        schema = extract_schema(args.sql_file)
+    except FileNotFoundError:
+        log.error("Please provide a valid SQL file.")
+        exit(1)
+    except Exception as e:
+        log.error(f"Failed to extract schema: {e}")
+        exit(4)
+    # create the output directory if it does not exist
+    try:
+        os.makedirs(args.output_dir, exist_ok=True)
+    except FileExistsError:
+        log.error("Please provide a valid output directory.")
         exit(3)
+    except OSError:
+        log.error("Output directory not found and could not be created.")
+        exit(2)
     output_file = os.path.join(
-        args.output_dir,
-        os.path.basename(args.sql_file).replace(".sql", "_schema.json"),
+        args.output_dir, f"{Path(args.sql_file).stem}_schema.json"
     )
     try:
-        schema = extract_schema(args.sql_file)
+        write_json(output_file, schema)
+        log.info(f"Schema saved to {output_file}")
     except Exception as e:
-        print(f"Failed to extract schema: {e}")
-        exit(4)
-    with open(output_file, "w") as f:
-        try:
-            json.dump(schema, f, indent=2)
-            print(f"Schema saved to {output_file}")
-        except Exception as e:
-            print(f"Failed to save schema to file: {e}")
-            exit(5)
+        log.error(f"Failed to save schema to file: {e}")
+        exit(5)
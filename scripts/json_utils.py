@@ -0,0 +1,26 @@
+# ***************************************************************************************#
+# 											 #
+# FILE: json_utils.py									 #
+# 											 #
+# USAGE: from json_utils import write_json						 #
+# 											 #
+# DESCRIPTION: JSON output helpers shared by the scripts.				 #
+# 											 #
+# VERSION: 1.0										 #
+# 											 #
+# ***************************************************************************************#
+
+import orjson
+
+
+def write_json(output_file_path, data):
+    """
+    Write data to a JSON file with 2-space indentation, serialized by orjson.
+    Args: output_file_path (str): The path to the output json file.
+          data: The JSON serializable data.
+    Returns:
+        str: The path to the output json file.
+    """
+    with open(output_file_path, "wb") as output_file:
+        output_file.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    return output_file_path